@@ -12,36 +12,62 @@ The script uses a composite unique constraint (url, ip_address, user_agent, time
 to detect and skip duplicate records.
 
 Usage:
-    python migrate_to_postgres.py [--sqlite-db PATH] [--dry-run] [--force]
+    python migrate_to_postgres.py [--sqlite-db PATH] [--dry-run] [--force] [--no-copy]
 
 Options:
     --sqlite-db PATH    Path to SQLite database (default: ./data/visits.db)
     --dry-run          Show what would be migrated without actually doing it
     --force            Skip confirmation prompts
+    --no-copy          Use multi-row INSERTs instead of COPY (no temp table needed)
 """
 
 import sqlite3
 import psycopg2
+from psycopg2.extras import execute_values
 import os
 import sys
 import argparse
+import csv
+import io
+import queue
+import threading
+from contextlib import contextmanager
+from itertools import islice
 from datetime import datetime
 from urllib.parse import urlparse
 from pathlib import Path
+from dotenv import load_dotenv
 
-# Load environment variables from .env file
-def load_env_file():
-    """Load environment variables from .env file"""
-    env_path = Path(__file__).parent / '.env'
-    if env_path.exists():
-        with open(env_path) as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.split('=', 1)
-                    os.environ.setdefault(key.strip(), value.strip())
+# Load environment variables from .env file (existing environment variables win)
+load_dotenv(Path(__file__).parent / '.env', override=False)
 
-load_env_file()
+# Number of SQLite rows streamed into PostgreSQL per COPY batch
+BATCH_SIZE = 10000
+
+# Batches read ahead from SQLite while the previous batch is written to PostgreSQL
+PREFETCH_DEPTH = 4
+
+# Marker COPY uses for NULL, so NULLs stay distinct from empty strings
+COPY_NULL = r'\N'
+
+# Rows PostgreSQL rejects are reported and skipped, up to this many per run
+MAX_ERRORS = 10
+
+# Applied to the source SQLite connection. These only tune this reader (a larger page
+# cache and mmap window speed up the full-table scan); nothing here writes to the file
+SQLITE_PRAGMAS = (
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+)
+
+def connect_sqlite(sqlite_path):
+    """Open a SQLite connection with the tuned PRAGMAs applied"""
+    # Rows are fetched on the prefetch thread, not the thread that opened the connection
+    conn = sqlite3.connect(sqlite_path, check_same_thread=False)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
 
 def get_postgres_connection():
     """Get PostgreSQL connection from environment"""
@@ -127,50 +153,180 @@ def verify_postgres_schema(pg_conn):
     cursor.close()
     print("✓ PostgreSQL schema verified with unique constraint for deduplication")
 
-def get_sqlite_records(sqlite_path, since_timestamp=None):
-    """Read records from SQLite database, optionally filtering by timestamp"""
+@contextmanager
+def iter_sqlite_records(sqlite_path, since_timestamp=None, chunk=BATCH_SIZE):
+    """Count SQLite records, optionally filtering by timestamp, and stream them lazily.
+
+    Yields ``(count, records)`` where ``records`` is a generator reading rows in
+    ``chunk``-sized ``fetchmany`` batches. The SQLite connection stays open until
+    the ``with`` block exits.
+    """
     if not os.path.exists(sqlite_path):
         raise FileNotFoundError(f"SQLite database not found: {sqlite_path}")
 
-    conn = sqlite3.connect(sqlite_path)
-    cursor = conn.cursor()
+    conn = connect_sqlite(sqlite_path)
+    try:
+        cursor = conn.cursor()
+        cursor.arraysize = chunk
 
-    # Build query with optional timestamp filter
-    if since_timestamp:
-        query = "SELECT id, url, ip_address, user_agent, timestamp FROM visits WHERE timestamp > ? ORDER BY timestamp"
-        cursor.execute(query, (since_timestamp,))
-    else:
-        query = "SELECT id, url, ip_address, user_agent, timestamp FROM visits ORDER BY timestamp"
-        cursor.execute(query)
+        # Build query with optional timestamp filter
+        if since_timestamp:
+            where, params = " WHERE timestamp > ?", (since_timestamp,)
+        else:
+            where, params = "", ()
+
+        # Get total count up front so progress can be reported while streaming
+        cursor.execute("SELECT COUNT(*) FROM visits" + where, params)
+        count = cursor.fetchone()[0]
+
+        def records():
+            cursor.execute(
+                "SELECT id, url, ip_address, user_agent, timestamp FROM visits" + where + " ORDER BY timestamp",
+                params
+            )
+            for rows in iter(cursor.fetchmany, []):
+                yield from rows
+
+        yield count, records()
+    finally:
+        conn.close()
 
-    records = cursor.fetchall()
+def prefetch_batches(records, batch_size=BATCH_SIZE, depth=PREFETCH_DEPTH):
+    """Yield lists of records read on a background thread.
+
+    Up to ``depth`` batches are buffered, so reading from SQLite overlaps with
+    writing the previous batch to PostgreSQL instead of running after it.
+    """
+    batches = queue.Queue(maxsize=depth)
+
+    def produce():
+        try:
+            while True:
+                batch = list(islice(records, batch_size))
+                batches.put(batch)
+                if not batch:
+                    return
+        except Exception as e:
+            batches.put(e)
+
+    threading.Thread(target=produce, name="sqlite-reader", daemon=True).start()
+
+    while True:
+        batch = batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        if not batch:
+            return
+        yield batch
+
+def check_existing_records(pg_conn, exact=False):
+    """Check if PostgreSQL already has records and return count + latest timestamp.
+
+    Unless ``exact`` is set, the count is the planner's row estimate from
+    pg_class, which is O(1) instead of a full-table COUNT(*).
+    """
+    cursor = pg_conn.cursor()
 
-    # Get total count
-    if since_timestamp:
-        cursor.execute("SELECT COUNT(*) FROM visits WHERE timestamp > ?", (since_timestamp,))
-    else:
-        cursor.execute("SELECT COUNT(*) FROM visits")
-    count = cursor.fetchone()[0]
+    # MAX() is answered from idx_timestamp, so this stays cheap on large tables
+    cursor.execute("SELECT MAX(timestamp) FROM visits")
+    latest_timestamp = cursor.fetchone()[0]
 
-    conn.close()
+    count = 0
+    if latest_timestamp is not None and not exact:
+        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = 'visits'::regclass")
+        count = cursor.fetchone()[0]
+    if latest_timestamp is not None and count <= 0:
+        # Exact count requested, or the table hasn't been analyzed yet
+        cursor.execute("SELECT COUNT(*) FROM visits")
+        count = cursor.fetchone()[0]
 
-    return records, count
+    cursor.close()
+    return count, latest_timestamp
 
-def check_existing_records(pg_conn):
-    """Check if PostgreSQL already has records and return count + latest timestamp"""
-    cursor = pg_conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM visits")
-    count = cursor.fetchone()[0]
+def create_staging_table(cursor):
+    """Create the session-local table COPY loads into before deduplication"""
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS visits_stage (
+            url TEXT,
+            ip_address TEXT,
+            user_agent TEXT,
+            timestamp TIMESTAMP
+        ) ON COMMIT DELETE ROWS
+    """)
 
-    latest_timestamp = None
-    if count > 0:
-        cursor.execute("SELECT MAX(timestamp) FROM visits")
-        latest_timestamp = cursor.fetchone()[0]
+def copy_batch(cursor, records):
+    """COPY a batch of SQLite records into the stage and merge them into visits.
+
+    Returns the number of rows actually inserted; the remainder were duplicates.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for sqlite_id, url, ip_address, user_agent, timestamp in records:
+        writer.writerow([
+            COPY_NULL if value is None else value
+            for value in (url, ip_address, user_agent, timestamp)
+        ])
+    buf.seek(0)
+
+    cursor.copy_expert(
+        "COPY visits_stage (url, ip_address, user_agent, timestamp) "
+        f"FROM STDIN WITH (FORMAT CSV, NULL '{COPY_NULL}')",
+        buf
+    )
+    cursor.execute("""
+        INSERT INTO visits (url, ip_address, user_agent, timestamp)
+        SELECT url, ip_address, user_agent, timestamp FROM visits_stage
+        ON CONFLICT ON CONSTRAINT visits_unique_record DO NOTHING
+    """)
+    return cursor.rowcount
+
+def insert_batch(cursor, records):
+    """Insert a batch with multi-row INSERTs, for servers where COPY/TEMP tables aren't allowed.
+
+    Returns the number of rows actually inserted; the remainder were duplicates.
+    """
+    inserted = execute_values(
+        cursor,
+        """
+        INSERT INTO visits (url, ip_address, user_agent, timestamp)
+        VALUES %s
+        ON CONFLICT ON CONSTRAINT visits_unique_record DO NOTHING
+        RETURNING id
+        """,
+        [record[1:] for record in records],
+        page_size=1000,
+        fetch=True
+    )
+    return len(inserted)
 
-    cursor.close()
-    return count, latest_timestamp
+def insert_rows(cursor, records):
+    """Insert a batch one row at a time after a batched write failed, skipping rows PostgreSQL rejects.
 
-def migrate_records(sqlite_path, dry_run=False, force=False):
+    Returns ``(inserted, errors)``; each rejected row is reported and rolled back to its savepoint.
+    """
+    inserted = 0
+    errors = 0
+    for sqlite_id, url, ip_address, user_agent, timestamp in records:
+        cursor.execute("SAVEPOINT record")
+        try:
+            cursor.execute(
+                """
+                INSERT INTO visits (url, ip_address, user_agent, timestamp)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT ON CONSTRAINT visits_unique_record DO NOTHING
+                """,
+                (url, ip_address, user_agent, timestamp)
+            )
+            inserted += cursor.rowcount
+        except (psycopg2.Error, ValueError) as e:
+            # ValueError is psycopg2 refusing a NUL character before sending the row
+            cursor.execute("ROLLBACK TO SAVEPOINT record")
+            errors += 1
+            print(f"   ✗ Error migrating record ID {sqlite_id}: {e}")
+        cursor.execute("RELEASE SAVEPOINT record")
+    return inserted, errors
+
+def migrate_records(sqlite_path, dry_run=False, force=False, use_copy=True):
     """Migrate records from SQLite to PostgreSQL with incremental sync support"""
     print(f"Starting incremental migration from {sqlite_path}")
     print("=" * 70)
@@ -191,8 +347,8 @@ def migrate_records(sqlite_path, dry_run=False, force=False):
     # Check existing records and get latest timestamp
     existing_count, latest_timestamp = check_existing_records(pg_conn)
 
-    if existing_count > 0:
-        print(f"\n   PostgreSQL already contains {existing_count:,} records")
+    if latest_timestamp is not None:
+        print(f"\n   PostgreSQL already contains ~{existing_count:,} records")
         print(f"   Latest timestamp: {latest_timestamp}")
         print(f"   Will sync only records newer than this timestamp...")
     else:
@@ -200,84 +356,78 @@ def migrate_records(sqlite_path, dry_run=False, force=False):
 
     # Read SQLite records (only newer than latest if incremental)
     print(f"\n4. Reading records from SQLite database...")
-    records, sqlite_count = get_sqlite_records(sqlite_path, since_timestamp=latest_timestamp)
-
-    if sqlite_count == 0:
-        print(f"   ✓ No new records to migrate - databases are in sync!")
-        pg_conn.close()
-        return
-
-    print(f"   Found {sqlite_count:,} new/updated records to migrate")
-
-    if dry_run:
-        print(f"\n🔍 DRY RUN MODE - Would migrate {sqlite_count:,} records")
-        print("\nSample records to be migrated:")
-        for i, record in enumerate(records[:5], 1):
-            print(f"  {i}. ID={record[0]}, URL={record[1][:50]}, TS={record[4]}")
-        if len(records) > 5:
-            print(f"  ... and {len(records) - 5} more records")
-        pg_conn.close()
-        return
-
-    # Migrate records with ON CONFLICT DO NOTHING for safety
-    print(f"\n5. Migrating records to PostgreSQL (skipping duplicates)...")
-    cursor = pg_conn.cursor()
-
-    migrated = 0
-    skipped = 0
-    errors = 0
-
-    try:
-        for i, record in enumerate(records, 1):
-            sqlite_id, url, ip_address, user_agent, timestamp = record
-
-            try:
-                # Insert record with ON CONFLICT DO NOTHING to skip duplicates
-                cursor.execute(
-                    """
-                    INSERT INTO visits (url, ip_address, user_agent, timestamp)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT ON CONSTRAINT visits_unique_record DO NOTHING
-                    """,
-                    (url, ip_address, user_agent, timestamp)
-                )
-
-                # Check if row was actually inserted
-                if cursor.rowcount > 0:
-                    migrated += 1
-                else:
-                    skipped += 1
-
-                # Progress indicator
-                if i % 1000 == 0:
-                    print(f"   Processed {i:,} / {sqlite_count:,} records (inserted: {migrated:,}, skipped: {skipped:,})...")
-                    pg_conn.commit()  # Commit every 1000 records
-
-            except Exception as e:
-                errors += 1
-                print(f"   ✗ Error migrating record ID {sqlite_id}: {e}")
-                if errors > 10:
-                    print("   Too many errors, stopping migration.")
-                    raise
-
-        # Final commit
-        pg_conn.commit()
-        print(f"   ✓ Processed {len(records):,} records")
-        print(f"   ✓ Inserted {migrated:,} new records")
-        print(f"   ✓ Skipped {skipped:,} duplicate records")
+    with iter_sqlite_records(sqlite_path, since_timestamp=latest_timestamp) as (sqlite_count, records):
+        if sqlite_count == 0:
+            print(f"   ✓ No new records to migrate - databases are in sync!")
+            pg_conn.close()
+            return
+
+        print(f"   Found {sqlite_count:,} new/updated records to migrate")
+
+        if dry_run:
+            print(f"\n🔍 DRY RUN MODE - Would migrate {sqlite_count:,} records")
+            print("\nSample records to be migrated:")
+            for i, record in enumerate(islice(records, 5), 1):
+                print(f"  {i}. ID={record[0]}, URL={record[1][:50]}, TS={record[4]}")
+            if sqlite_count > 5:
+                print(f"  ... and {sqlite_count - 5:,} more records")
+            pg_conn.close()
+            return
+
+        # Stream records through a COPY staging table (or multi-row INSERTs), skipping duplicates
+        print(f"\n5. Migrating records to PostgreSQL (skipping duplicates)...")
+        cursor = pg_conn.cursor()
+        if use_copy:
+            create_staging_table(cursor)
+            pg_conn.commit()  # Keep the stage if the first batch has to be rolled back
+            write_batch = copy_batch
+        else:
+            write_batch = insert_batch
+
+        processed = 0
+        migrated = 0
+        skipped = 0
+        errors = 0
+
+        try:
+            for batch in prefetch_batches(records):
+                batch_errors = 0
+                try:
+                    inserted = write_batch(cursor, batch)
+                except (psycopg2.Error, ValueError) as e:
+                    # One bad row fails the whole batch; redo it row by row so only that row is lost
+                    pg_conn.rollback()
+                    print(f"   ⚠ Batch failed ({e}); retrying it row by row...")
+                    inserted, batch_errors = insert_rows(cursor, batch)
+                    errors += batch_errors
+                    if errors > MAX_ERRORS:
+                        pg_conn.rollback()
+                        raise RuntimeError("Too many errors, stopping migration.")
+                pg_conn.commit()  # Commit every batch; ON COMMIT DELETE ROWS empties the stage
+
+                processed += len(batch)
+                migrated += inserted
+                skipped += len(batch) - inserted - batch_errors
+                print(f"   Processed {processed:,} / {sqlite_count:,} records (inserted: {migrated:,}, skipped: {skipped:,})...")
+
+            print(f"   ✓ Processed {processed:,} records")
+            print(f"   ✓ Inserted {migrated:,} new records")
+            print(f"   ✓ Skipped {skipped:,} duplicate records")
+            if errors:
+                print(f"   ✗ Failed to migrate {errors:,} records")
+
+        except Exception as e:
+            print(f"\n✗ Migration failed: {e}")
+            pg_conn.rollback()
+            cursor.close()
+            pg_conn.close()
+            sys.exit(1)
 
-    except Exception as e:
-        print(f"\n✗ Migration failed: {e}")
-        pg_conn.rollback()
         cursor.close()
-        pg_conn.close()
-        sys.exit(1)
-
-    cursor.close()
 
     # Verify migration
     print(f"\n6. Verifying migration...")
-    final_count, final_latest = check_existing_records(pg_conn)
+    final_count, final_latest = check_existing_records(pg_conn, exact=True)
     print(f"   PostgreSQL now contains {final_count:,} total records")
 
     # Get timestamp range
@@ -320,11 +470,16 @@ def main():
         action="store_true",
         help="Skip confirmation prompts"
     )
+    parser.add_argument(
+        "--no-copy",
+        action="store_true",
+        help="Use multi-row INSERTs instead of COPY (no temp table needed)"
+    )
 
     args = parser.parse_args()
 
     try:
-        migrate_records(args.sqlite_db, dry_run=args.dry_run, force=args.force)
+        migrate_records(args.sqlite_db, dry_run=args.dry_run, force=args.force, use_copy=not args.no_copy)
     except KeyboardInterrupt:
         print("\n\nMigration cancelled by user.")
         sys.exit(1)
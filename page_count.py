@@ -1,45 +1,49 @@
-from fastapi import FastAPI, Request, Query, Response
+from fastapi import FastAPI, HTTPException, Header, Request, Query, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 from datetime import datetime
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import logging
 import os
 from typing import Optional
-import json
-from dateutil import parser as date_parser
+import csv
+import io
+import orjson
 from urllib.parse import urlparse, parse_qs
 from pathlib import Path
+from dotenv import load_dotenv
+from collections import Counter
+from contextlib import contextmanager
+import hashlib
+import queue
+import re
+import threading
 import time
 
 
+# Site origins stripped by normalize_url; str.startswith checks them all in one call
+SITE_PREFIXES = ("https://www.kevsrobots.com/", "http://www.kevsrobots.com/",
+                 "https://kevsrobots.com/", "http://kevsrobots.com/")
+
 def normalize_url(url: str) -> str:
     """Strip domain to get a relative path matching historic page_views data."""
-    for prefix in ("https://www.kevsrobots.com/", "http://www.kevsrobots.com/",
-                    "https://kevsrobots.com/", "http://kevsrobots.com/"):
-        if url.startswith(prefix):
-            path = url[len(prefix):]
-            return path if path else "index.html"
-    return url
-
-# Load environment variables from .env file
-def load_env_file():
-    """Load environment variables from .env file"""
-    env_path = Path(__file__).parent / '.env'
-    if env_path.exists():
-        with open(env_path) as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.split('=', 1)
-                    os.environ.setdefault(key.strip(), value.strip())
-
-load_env_file()
+    if not url.startswith(SITE_PREFIXES):
+        return url
+    path = url.partition("kevsrobots.com/")[2]
+    return path if path else "index.html"
+
+# Load environment variables from .env file (existing environment variables win)
+load_dotenv(Path(__file__).parent / '.env', override=False)
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 # Database configuration from environment
@@ -48,6 +52,12 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is not set. Please check your .env file.")
 
+# Number of URLs returned in the /stats popular_pages breakdown
+POPULAR_PAGES_LIMIT = 50
+
+# Seconds a computed /stats response is served from memory
+STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", "30"))
+
 def get_db_connection(max_retries=3, retry_delay=2):
     """Create a new database connection with retry logic"""
     for attempt in range(max_retries):
@@ -62,6 +72,43 @@ def get_db_connection(max_retries=3, retry_delay=2):
                 logger.error(f"Failed to connect to database after {max_retries} attempts")
                 raise
 
+# Warm connection pool shared by all request handlers, created on startup
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "5"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+
+db_pool = None
+# ThreadedConnectionPool raises when exhausted; make callers wait for a free connection instead
+db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+# Hot-path statements prepared once per pooled connection, so the server
+# parses and plans them once instead of on every request
+PREPARED_STATEMENTS = {
+    "count_url_visits": "SELECT count FROM url_counts WHERE url = $1",
+}
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """Connection that prepares PREPARED_STATEMENTS as soon as it is opened"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        with self.cursor() as cursor:
+            for name, statement in PREPARED_STATEMENTS.items():
+                cursor.execute(f"PREPARE {name} AS {statement}")
+        self.commit()
+
+def init_pool():
+    """Open the shared connection pool"""
+    global db_pool
+    db_pool = ThreadedConnectionPool(
+        DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, connection_factory=PreparedConnection
+    )
+    logger.info(f"Database pool ready ({DB_POOL_MIN}-{DB_POOL_MAX} connections)")
+
+def close_pool():
+    """Close every connection in the shared pool"""
+    if db_pool is not None:
+        db_pool.closeall()
+
 def init_database(max_retries=10, retry_delay=5):
     """Initialize the PostgreSQL database with retry logic for startup"""
     logger.info("Initializing database...")
@@ -82,9 +129,53 @@ def init_database(max_retries=10, retry_delay=5):
             """)
 
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_page_views_url ON page_views(url)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_page_views_viewed_at ON page_views(viewed_at)")
+
+            # Running per-URL totals, updated by the visit writer in the same transaction
+            # as each batch, so visit counts are a primary key lookup instead of COUNT(*)
+            cursor.execute("SELECT to_regclass('url_counts') IS NULL")
+            backfill = cursor.fetchone()[0]
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS url_counts (
+                    url VARCHAR PRIMARY KEY,
+                    count BIGINT NOT NULL DEFAULT 0
+                )
+            """)
+            if backfill:
+                cursor.execute("INSERT INTO url_counts (url, count) SELECT url, COUNT(*) FROM page_views GROUP BY url")
+
+            # Distinct visitor IPs, so unique_visitors counts this small table instead of
+            # hashing every page_views row with COUNT(DISTINCT ip_address)
+            cursor.execute("SELECT to_regclass('visitor_ips') IS NULL")
+            backfill = cursor.fetchone()[0]
+            cursor.execute("CREATE TABLE IF NOT EXISTS visitor_ips (ip_address VARCHAR PRIMARY KEY)")
+            if backfill:
+                cursor.execute("""
+                    INSERT INTO visitor_ips (ip_address)
+                    SELECT DISTINCT ip_address FROM page_views WHERE ip_address IS NOT NULL
+                """)
 
             conn.commit()
+
+            # Covering index for recent visits and date-range scans; it replaces the plain
+            # viewed_at index and is built concurrently so writes aren't blocked
+            conn.autocommit = True
+            cursor.execute("""
+                SELECT indisvalid FROM pg_index
+                WHERE indexrelid = to_regclass('idx_page_views_viewed_at_covering')
+            """)
+            covering = cursor.fetchone()
+            if covering and not covering[0]:
+                # An interrupted concurrent build leaves an INVALID index behind; rebuild it
+                logger.warning("Rebuilding invalid index idx_page_views_viewed_at_covering")
+                cursor.execute("DROP INDEX CONCURRENTLY idx_page_views_viewed_at_covering")
+                covering = None
+            if covering is None:
+                cursor.execute("""
+                    CREATE INDEX CONCURRENTLY idx_page_views_viewed_at_covering
+                    ON page_views (viewed_at DESC) INCLUDE (url, ip_address)
+                """)
+            # Reached only once the covering index exists and is valid
+            cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_page_views_viewed_at")
             cursor.close()
             conn.close()
             logger.info("Database initialized successfully!")
@@ -104,18 +195,12 @@ def init_database(max_retries=10, retry_delay=5):
 class VisitRequest(BaseModel):
     url: str
 
-class VisitResponse(BaseModel):
-    url: str
-    ip: str
-    user_agent: str
-    status: str
-    timestamp: str
-
 # Create FastAPI app
 app = FastAPI(
     title="Simple Page Visit Counter",
     description="A simple API to track page visits using PostgreSQL",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Startup event to initialize database with retry logic
@@ -123,6 +208,14 @@ app = FastAPI(
 async def startup_event():
     """Initialize database on application startup"""
     init_database()
+    init_pool()
+    start_visit_writer()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Flush queued visits and release database connections on application shutdown"""
+    stop_visit_writer()
+    close_pool()
 
 # Add CORS middleware to allow browser requests
 app.add_middleware(
@@ -133,58 +226,326 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Last formatted wall-clock second, swapped as one tuple so threads never see a mismatched pair
+timestamp_cache = (-1, "")
+
+def current_timestamp() -> str:
+    """Local time as 'YYYY-MM-DD HH:MM:SS', formatted at most once per second"""
+    global timestamp_cache
+    now = int(time.time())
+    second, formatted = timestamp_cache
+    if now != second:
+        formatted = datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S")
+        timestamp_cache = (now, formatted)
+    return formatted
+
 # Helper function to get client IP
-def get_client_ip(request: Request) -> str:
-    """Get the client IP address from the request"""
-    forwarded = request.headers.get("X-Forwarded-For")
+def get_client_ip(request: Request, forwarded: Optional[str] = None) -> str:
+    """Get the client IP address from the X-Forwarded-For header value, else the socket peer"""
     if forwarded:
-        return forwarded.split(",")[0].strip()
+        return forwarded.partition(",")[0].strip()
     return request.client.host if request.client else "unknown"
 
-# Helper function to execute database queries
-def execute_query(query: str, params: tuple = (), fetch: str = None):
-    """Execute a database query and return results"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# Helper to reject visit fields the database can't store
+def check_storable(**fields: str):
+    """Raise 400 for values a PostgreSQL text column can't hold (NUL characters, lone surrogates)"""
+    for name, value in fields.items():
+        if "\x00" in value:
+            raise HTTPException(status_code=400, detail=f"{name} must not contain NUL characters")
+        if not value.isascii():
+            try:
+                value.encode("utf-8")
+            except UnicodeEncodeError:
+                raise HTTPException(status_code=400, detail=f"{name} is not valid UTF-8")
+
+# Helper to tell a dead connection apart from a failed query
+def connection_lost(e: Exception) -> bool:
+    """Whether a psycopg2 error means the connection itself is gone (e.g. the database restarted)"""
+    if isinstance(e, psycopg2.InterfaceError):
+        return True
+    # Lost sockets carry no pgcode; 08xxx/57Pxx are connection failures and server shutdowns
+    return isinstance(e, psycopg2.OperationalError) and (
+        e.pgcode is None or e.pgcode.startswith(("08", "57P"))
+    )
+
+# Helper to borrow a connection from the shared pool
+@contextmanager
+def pooled_connection():
+    """Borrow a pooled connection, rolling back and discarding it as needed on error"""
+    with db_pool_slots:
+        conn = db_pool.getconn()
+        # Skip connections already known to be closed instead of handing them out
+        while conn.closed:
+            db_pool.putconn(conn, close=True)
+            conn = db_pool.getconn()
+        broken = False
 
-    try:
-        cursor.execute(query, params)
+        try:
+            yield conn
+
+        except BaseException as e:
+            # Leave no open or aborted transaction behind (this includes a streaming
+            # response abandoned by the client); drop the connection if it died.
+            # After a server restart a dead connection can still report closed == 0
+            broken = conn.closed != 0 or (isinstance(e, psycopg2.Error) and connection_lost(e))
+            if not broken:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            raise
+
+        finally:
+            db_pool.putconn(conn, close=broken)
 
-        if fetch == "one":
-            result = cursor.fetchone()
-        elif fetch == "all":
-            result = cursor.fetchall()
-        else:
-            result = None
+# Helper function to execute database queries
+def execute_query(query: str, params: tuple = (), fetch: str = None, retries: int = DB_POOL_MAX):
+    """Execute a database query on a pooled connection and return results.
 
-        conn.commit()
-        return result
+    If the pooled connection turns out to be dead (e.g. the database restarted),
+    it is discarded and the query retried on the next one. After a restart every
+    idle connection is dead, so the default allows one retry per pool slot.
+    """
+    try:
+        with pooled_connection() as conn:
+            cursor = conn.cursor()
 
+            try:
+                cursor.execute(query, params)
+
+                if fetch == "one":
+                    result = cursor.fetchone()
+                elif fetch == "all":
+                    result = cursor.fetchall()
+                else:
+                    result = None
+
+                conn.commit()
+                return result
+
+            finally:
+                if not cursor.closed:
+                    cursor.close()
+
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        # Query errors (timeouts, cancellations) are raised as-is; only lost connections retry
+        if not connection_lost(e) or retries <= 0:
+            raise
+        logger.warning(f"Database connection lost ({e}); retrying on another connection")
+        return execute_query(query, params, fetch, retries - 1)
+
+# Visit writes are queued by the handlers and inserted in batches by a background thread
+VISIT_BATCH_SIZE = 500
+VISIT_FLUSH_INTERVAL = 0.1  # seconds to wait for more visits before flushing a partial batch
+VISIT_QUEUE_MAX = int(os.getenv("VISIT_QUEUE_MAX", "10000"))
+
+VISIT_COUNT_ATTEMPTS = 3  # reads of url_counts before settling for a count that raced a commit
+
+# A batch that can't reach the database is retried, backing off from VISIT_RETRY_DELAY
+# up to VISIT_RETRY_MAX_DELAY seconds between attempts (about two minutes in all)
+VISIT_WRITE_ATTEMPTS = 10
+VISIT_RETRY_DELAY = 0.5
+VISIT_RETRY_MAX_DELAY = 30
+
+# Errors caused by the rows themselves rather than the connection; psycopg2 raises
+# ValueError client-side for NUL characters and UnicodeEncodeError for lone surrogates
+VISIT_DATA_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError, ValueError)
+
+visit_queue = queue.Queue(maxsize=VISIT_QUEUE_MAX)
+# Queued-but-unwritten visits per URL, so reported counts include them
+pending_counts = Counter()
+pending_lock = threading.Lock()
+# Bumped under pending_lock before and after each batch commit (odd while one is in
+# flight), so visit_count() can tell when its database read straddled a commit
+visit_write_seq = 0
+visit_writer_thread = None
+
+def enqueue_visit(url: str, ip: str, user_agent: str, timestamp: str):
+    """Queue a visit for the background writer, or raise 503 if the queue is full"""
+    with pending_lock:
+        try:
+            visit_queue.put_nowait((url, ip, user_agent, timestamp))
+        except queue.Full:
+            raise HTTPException(status_code=503, detail="Visit queue is full, please try again later")
+        pending_counts[url] += 1
+
+def visit_count(url: str) -> int:
+    """Total visits for a URL, including any still waiting in the write queue.
+
+    A batch is counted by url_counts once it commits and by pending_counts until the
+    writer settles it, so a read that overlaps a commit could count it twice or not
+    at all; such reads are retried.
+    """
+    for _ in range(VISIT_COUNT_ATTEMPTS):
+        with pending_lock:
+            seq = visit_write_seq
+        total_row = execute_query("EXECUTE count_url_visits (%s)", (url,), fetch="one")
+        with pending_lock:
+            pending = pending_counts[url]
+            if seq % 2 == 0 and visit_write_seq == seq:
+                break
+    return (total_row[0] if total_row else 0) + pending
+
+def copy_visits(cursor, batch):
+    """COPY a batch of visits into page_views and add them to the url_counts / visitor_ips rollups"""
+    # Every field is quoted, so empty strings are kept rather than read as NULL
+    buf = io.StringIO()
+    csv.writer(buf, quoting=csv.QUOTE_ALL).writerows(batch)
+    buf.seek(0)
+    cursor.copy_expert(
+        "COPY page_views (url, ip_address, user_agent, viewed_at) FROM STDIN WITH (FORMAT CSV)",
+        buf
+    )
+    # Sorted so concurrent writers always lock url_counts rows in the same order
+    execute_values(
+        cursor,
+        """
+        INSERT INTO url_counts (url, count) VALUES %s
+        ON CONFLICT (url) DO UPDATE SET count = url_counts.count + EXCLUDED.count
+        """,
+        sorted(Counter(url for url, _, _, _ in batch).items())
+    )
+    execute_values(
+        cursor,
+        "INSERT INTO visitor_ips (ip_address) VALUES %s ON CONFLICT DO NOTHING",
+        [(ip,) for ip in sorted({ip for _, ip, _, _ in batch})]
+    )
+
+def insert_visits(cursor, batch):
+    """Write a batch one visit at a time, each under a savepoint, so a row PostgreSQL
+    rejects is dropped on its own instead of taking the rest of the batch with it"""
+    for visit in sorted(batch):
+        url, ip, _, _ = visit
+        cursor.execute("SAVEPOINT visit")
+        try:
+            cursor.execute(
+                "INSERT INTO page_views (url, ip_address, user_agent, viewed_at) VALUES (%s, %s, %s, %s)",
+                visit
+            )
+            cursor.execute(
+                """
+                INSERT INTO url_counts (url, count) VALUES (%s, 1)
+                ON CONFLICT (url) DO UPDATE SET count = url_counts.count + 1
+                """,
+                (url,)
+            )
+            cursor.execute("INSERT INTO visitor_ips (ip_address) VALUES (%s) ON CONFLICT DO NOTHING", (ip,))
+        except VISIT_DATA_ERRORS as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT visit")
+            logger.error(f"Dropping unstorable visit {visit!r}: {e}")
+        cursor.execute("RELEASE SAVEPOINT visit")
+
+def write_visits(batch):
+    """Write a batch of queued visits and update the rollups in one transaction.
+
+    If PostgreSQL rejects the batch's data, it is rewritten row by row so only the
+    offending visits are lost. If the database can't be reached, the batch is retried
+    with backoff for up to VISIT_WRITE_ATTEMPTS attempts before it is given up on.
+    """
+    global visit_write_seq
+    attempt = 0
+    dead_connections = 0
+    try:
+        while True:
+            try:
+                with pooled_connection() as conn:
+                    with conn.cursor() as cursor:
+                        try:
+                            copy_visits(cursor, batch)
+                        except VISIT_DATA_ERRORS as e:
+                            conn.rollback()
+                            logger.warning(f"Batch of {len(batch)} visits rejected ({e}); writing them one at a time")
+                            insert_visits(cursor, batch)
+                    with pending_lock:
+                        visit_write_seq += 1
+                    conn.commit()
+                stats_cache["stale"] = True
+                return
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                # The attempt may have failed mid-commit; reopen the bracket on the next one
+                with pending_lock:
+                    if visit_write_seq % 2:
+                        visit_write_seq += 1
+                # After a restart every idle pooled connection is dead; the failed one has
+                # been discarded, so move straight on to the next before backing off
+                if connection_lost(e) and dead_connections < DB_POOL_MAX:
+                    dead_connections += 1
+                    continue
+                attempt += 1
+                if attempt == VISIT_WRITE_ATTEMPTS:
+                    raise
+                delay = min(VISIT_RETRY_DELAY * 2 ** (attempt - 1), VISIT_RETRY_MAX_DELAY)
+                logger.warning(f"Writing {len(batch)} queued visits failed ({e}); retrying in {delay}s")
+                time.sleep(delay)
+    except Exception as e:
+        logger.error(f"Error writing {len(batch)} queued visits, dropping them: {e}")
     finally:
-        cursor.close()
-        conn.close()
+        # Settle the batch in the same step that ends the commit bracket
+        with pending_lock:
+            if visit_write_seq % 2:
+                visit_write_seq += 1
+            for url, _, _, _ in batch:
+                pending_counts[url] -= 1
+                if pending_counts[url] <= 0:
+                    del pending_counts[url]
+
+def visit_writer():
+    """Drain the visit queue, flushing every VISIT_BATCH_SIZE rows or VISIT_FLUSH_INTERVAL seconds"""
+    stopping = False
+    while not stopping:
+        visit = visit_queue.get()
+        if visit is None:
+            break
+        batch = [visit]
+        deadline = time.monotonic() + VISIT_FLUSH_INTERVAL
+
+        while len(batch) < VISIT_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                visit = visit_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if visit is None:
+                stopping = True
+                break
+            batch.append(visit)
+
+        write_visits(batch)
+
+def start_visit_writer():
+    """Start the background visit writer thread"""
+    global visit_writer_thread
+    visit_writer_thread = threading.Thread(target=visit_writer, name="visit-writer", daemon=True)
+    visit_writer_thread.start()
+
+def stop_visit_writer():
+    """Flush any queued visits and stop the writer thread"""
+    if visit_writer_thread is not None:
+        visit_queue.put(None)
+        visit_writer_thread.join()
 
 # Main endpoint to record a visit
-@app.post("/visit", response_model=VisitResponse)
-def record_visit(visit_data: VisitRequest, request: Request):
+@app.post("/visit")
+def record_visit(
+    visit_data: VisitRequest,
+    request: Request,
+    user_agent: str = Header("unknown"),
+    x_forwarded_for: Optional[str] = Header(None)
+):
     """Record a page visit"""
     try:
         url = normalize_url(visit_data.url)
-        ip = get_client_ip(request)
-        user_agent = request.headers.get("User-Agent", "unknown")
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        ip = get_client_ip(request, x_forwarded_for)
+        check_storable(url=url, ip=ip, user_agent=user_agent)
+        timestamp = current_timestamp()
 
-        execute_query(
-            "INSERT INTO page_views (url, ip_address, user_agent, viewed_at) VALUES (%s, %s, %s, %s)",
-            (url, ip, user_agent, timestamp)
-        )
+        enqueue_visit(url, ip, user_agent, timestamp)
 
-        logger.info(f"Visit recorded: {url} from {ip}")
+        logger.debug("Visit recorded: %s from %s", url, ip)
 
-        total_row = execute_query(
-            "SELECT COUNT(*) FROM page_views WHERE url = %s", (url,), fetch="one"
-        )
-        total = total_row[0] if total_row else 0
+        total = visit_count(url)
 
         return {
             "url": url,
@@ -194,41 +555,96 @@ def record_visit(visit_data: VisitRequest, request: Request):
             "timestamp": timestamp
         }
 
+    except HTTPException:
+        # Rejected input (400) or a full queue (503) is the client's answer, not a server error
+        raise
     except Exception as e:
         logger.error(f"Error recording visit: {e}")
         raise
 
+# /stats responses are cached in memory for STATS_CACHE_TTL seconds, or until new
+# visits are written, but are never recomputed more than once per STATS_MIN_AGE
+STATS_MIN_AGE = 2.0
+
+stats_cache = {"computed": 0.0, "expires": 0.0, "stale": False, "entry": None}
+stats_cache_lock = threading.Lock()
+
+def compute_stats():
+    """Run the /stats queries and build the response body"""
+    total_visits, unique_visitors = execute_query(
+        """
+        SELECT (SELECT COALESCE(SUM(count), 0)::bigint FROM url_counts),
+               (SELECT COUNT(*) FROM visitor_ips)
+        """,
+        fetch="one"
+    )
+
+    recent_visits = execute_query(
+        "SELECT url, ip_address, viewed_at FROM page_views ORDER BY viewed_at DESC LIMIT 10",
+        fetch="all"
+    )
+
+    url_counts = execute_query(
+        "SELECT url, count FROM url_counts ORDER BY count DESC LIMIT %s",
+        (POPULAR_PAGES_LIMIT,),
+        fetch="all"
+    )
+
+    return {
+        "total_visits": f"{total_visits:,}",
+        "unique_visitors": f"{unique_visitors:,}",
+        "popular_pages": {url: f"{count:,}" for url, count in (url_counts or [])},
+        "recent_visits": [
+            {
+                "url": url,
+                "ip": ip,
+                "timestamp": timestamp
+            }
+            for url, ip, timestamp in (recent_visits or [])
+        ]
+    }
+
+def fresh_stats():
+    """Return the cached (body, etag) for /stats, or None if it's missing, expired or invalidated"""
+    now = time.monotonic()
+    if now >= stats_cache["expires"]:
+        return None
+    if stats_cache["stale"] and now - stats_cache["computed"] >= STATS_MIN_AGE:
+        return None
+    return stats_cache["entry"]
+
+def cached_stats():
+    """Return (body, etag) for /stats, recomputing when expired or invalidated by a write"""
+    with stats_cache_lock:
+        # Another request may have recomputed while we waited for the lock
+        entry = fresh_stats()
+        if entry is None:
+            now = time.monotonic()
+            # Cleared before computing so a write landing mid-query still invalidates
+            stats_cache["stale"] = False
+            body = compute_stats()
+            digest = hashlib.sha1(orjson.dumps(body, option=orjson.OPT_SORT_KEYS)).hexdigest()
+            entry = (body, f'"{digest}"')
+            stats_cache.update(entry=entry, computed=now, expires=now + STATS_CACHE_TTL)
+        return entry
+
 # Get visit statistics
 @app.get("/stats")
-def get_stats():
+async def get_stats(request: Request, response: Response):
     """Get visit statistics"""
     try:
-        total_visits = execute_query("SELECT COUNT(*) FROM page_views", fetch="one")[0]
-        unique_visitors = execute_query("SELECT COUNT(DISTINCT ip_address) FROM page_views", fetch="one")[0]
-
-        recent_visits = execute_query(
-            "SELECT url, ip_address, viewed_at FROM page_views ORDER BY viewed_at DESC LIMIT 10",
-            fetch="all"
-        )
+        # Cache hits are answered on the event loop; only a recompute needs a worker thread
+        entry = fresh_stats()
+        if entry is None:
+            entry = await run_in_threadpool(cached_stats)
+        body, etag = entry
+        headers = {"ETag": etag, "Cache-Control": f"max-age={STATS_CACHE_TTL}"}
 
-        url_counts = execute_query(
-            "SELECT url, COUNT(*) as count FROM page_views GROUP BY url ORDER BY count DESC",
-            fetch="all"
-        )
+        if request.headers.get("If-None-Match") == etag:
+            return Response(status_code=304, headers=headers)
 
-        return {
-            "total_visits": f"{total_visits:,}",
-            "unique_visitors": f"{unique_visitors:,}",
-            "popular_pages": {url: f"{count:,}" for url, count in (url_counts or [])},
-            "recent_visits": [
-                {
-                    "url": url,
-                    "ip": ip,
-                    "timestamp": timestamp
-                }
-                for url, ip, timestamp in (recent_visits or [])
-            ]
-        }
+        response.headers.update(headers)
+        return body
 
     except Exception as e:
         logger.error(f"Error getting stats: {e}")
@@ -236,25 +652,24 @@ def get_stats():
 
 # Simple GET endpoint for easy testing
 @app.get("/")
-def record_visit_simple(url: str = Query(..., description="The URL being visited"), request: Request = None):
+def record_visit_simple(
+    url: str = Query(..., description="The URL being visited"),
+    request: Request = None,
+    user_agent: str = Header("unknown"),
+    x_forwarded_for: Optional[str] = Header(None)
+):
     """Simple endpoint to record a visit via GET request"""
     try:
         url = normalize_url(url)
-        ip = get_client_ip(request)
-        user_agent = request.headers.get("User-Agent", "unknown")
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        ip = get_client_ip(request, x_forwarded_for)
+        check_storable(url=url, ip=ip, user_agent=user_agent)
+        timestamp = current_timestamp()
 
-        execute_query(
-            "INSERT INTO page_views (url, ip_address, user_agent, viewed_at) VALUES (%s, %s, %s, %s)",
-            (url, ip, user_agent, timestamp)
-        )
+        enqueue_visit(url, ip, user_agent, timestamp)
 
-        total_row = execute_query(
-            "SELECT COUNT(*) FROM page_views WHERE url = %s", (url,), fetch="one"
-        )
-        total = total_row[0] if total_row else 0
+        total = visit_count(url)
 
-        logger.info(f"Visit recorded: {url} from {ip}")
+        logger.debug("Visit recorded: %s from %s", url, ip)
 
         return {
             "message": "Visit recorded!",
@@ -264,20 +679,101 @@ def record_visit_simple(url: str = Query(..., description="The URL being visited
             "visits": f"{total:,}"
         }
 
+    except HTTPException:
+        # Rejected input (400) or a full queue (503) is the client's answer, not a server error
+        raise
     except Exception as e:
         logger.error(f"Error recording visit: {e}")
         raise
 
 # Health check endpoint
 @app.get("/health")
-def health_check():
+async def health_check():
     """Check if the API is running"""
+    # Counts visits the writer has taken off the queue but not yet committed, too
+    with pending_lock:
+        queued = sum(pending_counts.values())
     return {
         "status": "healthy",
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "database": "connected"
+        "timestamp": current_timestamp(),
+        "database": "connected",
+        "queued_visits": queued
+    }
+
+# Rows fetched per round trip when streaming /all-visits
+STREAM_BATCH_SIZE = 1000
+
+# JSON Lines exports each hold a dedicated database connection while streaming
+EXPORT_MAX = int(os.getenv("EXPORT_MAX", "4"))
+export_slots = threading.BoundedSemaphore(EXPORT_MAX)
+
+# /all-visits column names, in the order the query selects them
+VISIT_FIELDS = ("url", "ip", "user_agent", "timestamp")
+
+# /all-visits range: "start,end", each a date optionally followed by " " or "T" and
+# HH:MM[:SS[.ffffff]]; a bare date means midnight. PostgreSQL parses the matched values
+RANGE_BOUND = r"\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?"
+RANGE_RE = re.compile(rf"\s*({RANGE_BOUND})\s*,\s*({RANGE_BOUND})\s*$")
+
+def visit_dict(url, ip, user_agent, timestamp):
+    """Shape a page_views row (timestamp already formatted by the query) for /all-visits"""
+    return {
+        "url": url,
+        "ip": ip,
+        "user_agent": user_agent,
+        "timestamp": timestamp
     }
 
+def open_visits_export(query: str, params: tuple):
+    """Start a JSON Lines export of /all-visits and return ``(lines, close)``.
+
+    An export lasts as long as the client takes to read it, so it runs on its own
+    connection rather than holding a pool slot the visit writer and /visit need, and
+    at most EXPORT_MAX run at once so exports can't use up the server's connections.
+    The query runs and its first batch is fetched here, before any response is sent,
+    so bad parameters or an unreachable database still fail the request properly.
+    ``close`` releases the connection and slot; it is safe to call more than once.
+    """
+    if not export_slots.acquire(blocking=False):
+        raise HTTPException(status_code=503, detail="Too many exports in progress, please try again later")
+    conn = None
+    try:
+        conn = get_db_connection(max_retries=1)
+        cursor = conn.cursor(name="all_visits_stream")
+        cursor.itersize = STREAM_BATCH_SIZE
+        cursor.execute(query, params)
+        first_batch = cursor.fetchmany(STREAM_BATCH_SIZE)
+    except BaseException:
+        if conn is not None:
+            conn.close()
+        export_slots.release()
+        raise
+
+    close_lock = threading.Lock()
+    closed = False
+
+    def close():
+        nonlocal closed
+        with close_lock:
+            if not closed:
+                closed = True
+                conn.close()
+                export_slots.release()
+
+    return stream_visits_jsonl(cursor, first_batch, close), close
+
+def stream_visits_jsonl(cursor, first_batch, close):
+    """Yield visits as JSON Lines from a server-side cursor, one batch of rows in memory at a time"""
+    try:
+        dumps = orjson.dumps
+        for url, ip, user_agent, timestamp in first_batch:
+            yield dumps({"url": url, "ip": ip, "user_agent": user_agent, "timestamp": timestamp}) + b"\n"
+        for url, ip, user_agent, timestamp in cursor:
+            yield dumps({"url": url, "ip": ip, "user_agent": user_agent, "timestamp": timestamp}) + b"\n"
+    finally:
+        # Also runs when the client disconnects mid-stream; closing ends the transaction
+        close()
+
 # Get all visits (useful for debugging)
 @app.get("/all-visits")
 def get_all_visits(
@@ -292,29 +788,33 @@ def get_all_visits(
 ):
     """Get all visits, with optional date range filtering."""
     try:
-        query = "SELECT url, ip_address, user_agent, viewed_at FROM page_views"
+        # Let PostgreSQL format the timestamp rather than reparsing it per row in Python
+        query = "SELECT url, ip_address, user_agent, to_char(viewed_at, 'YYYY-MM-DD HH24:MI:SS') FROM page_views"
         conditions = []
         params = []
 
         if range:
+            match = RANGE_RE.match(range)
             try:
-                start, end = [x.strip() for x in range.split(",")[:2]]
-                if len(start) == 10:
-                    start += " 00:00:00"
-                if len(end) == 10:
-                    end = end + " 00:00:00"
-                conditions.append("viewed_at >= %s")
-                params.append(start)
-                conditions.append("viewed_at < %s")
-                params.append(end)
-            except Exception as e:
-                logger.error(f"Invalid range parameter: {range} - {e}")
+                # The pattern only checks the shape; this rejects impossible dates like 2025-13-45
+                start, end = (datetime.fromisoformat(bound) for bound in match.group(1, 2))
+            except (AttributeError, ValueError):
+                # Dropping the filter would silently return the whole table
+                raise HTTPException(
+                    status_code=400,
+                    detail="range must be 'start,end' dates, e.g. 2025-09-01,2025-09-02 or 2025-09-01T10:00,2025-09-01T12:00"
+                )
+            conditions.append("viewed_at >= %s")
+            params.append(start)
+            conditions.append("viewed_at < %s")
+            params.append(end)
         else:
+            # Half-open bounds on the bare column keep the viewed_at index usable
             if start_date:
-                conditions.append("date(viewed_at) >= date(%s)")
+                conditions.append("viewed_at >= %s::date")
                 params.append(start_date)
             if end_date:
-                conditions.append("date(viewed_at) <= date(%s)")
+                conditions.append("viewed_at < %s::date + 1")
                 params.append(end_date)
             if since:
                 conditions.append("viewed_at > %s")
@@ -330,41 +830,30 @@ def get_all_visits(
             query += " OFFSET %s"
             params.append(offset)
 
-        visits = execute_query(query, tuple(params), fetch="all")
+        if format == "jsonl":
+            lines, close = open_visits_export(query, tuple(params))
+            # The background task also covers a client that leaves before the body starts
+            return StreamingResponse(lines, media_type="application/jsonl", background=BackgroundTask(close))
 
-        visit_dicts = []
-        for url, ip, user_agent, timestamp in (visits or []):
-            norm_ts = timestamp
-            try:
-                dt = date_parser.parse(str(timestamp))
-                norm_ts = dt.strftime("%Y-%m-%d %H:%M:%S")
-            except Exception as e:
-                logger.warning(f"Could not parse timestamp '{timestamp}': {e}")
-            visit_dicts.append({
-                "url": url,
-                "ip": ip,
-                "user_agent": user_agent,
-                "timestamp": norm_ts
-            })
+        visits = execute_query(query, tuple(params), fetch="all") or []
 
-        if format == "jsonl":
-            content = "\n".join(json.dumps(v, ensure_ascii=False) for v in visit_dicts)
-            return Response(content=content, media_type="application/jsonl")
-        elif format == "csv":
-            import io
-            import csv
+        if format == "csv":
+            # Rows are already in column order, so write the tuples as they are
             output = io.StringIO()
-            writer = csv.DictWriter(output, fieldnames=["url", "ip", "user_agent", "timestamp"])
-            writer.writeheader()
-            writer.writerows(visit_dicts)
+            writer = csv.writer(output)
+            writer.writerow(VISIT_FIELDS)
+            writer.writerows(visits)
             content = output.getvalue()
             output.close()
             return Response(content=content, media_type="text/csv")
         else:
+            visit_dicts = [visit_dict(*visit) for visit in visits]
             return {
                 "visits": visit_dicts,
                 "total_count": f"{len(visit_dicts):,}"
             }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting all visits: {e}")
         raise
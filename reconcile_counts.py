@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Rebuild the url_counts and visitor_ips rollup tables from page_views.
+
+The API keeps these tables up to date for the visits it records itself, and builds
+them from page_views when they are first created. Rows added to (or removed from)
+page_views any other way - a bulk load, a restore, manual SQL - are not reflected in
+/stats totals or "Visit #N" counts until the rollups are rebuilt with this script.
+
+It is safe to run while the API is serving. The comparison runs without locks, so a
+run that finds nothing to fix never gets in the API's way. Only when a rebuild is
+needed are the rollups locked against writes (reads carry on and keep seeing the old
+totals until the rebuild commits); the visit writer waits and then applies its batch
+on top. While the lock is held, visits queue up in the API, so run rebuilds at a quiet
+time on a large table.
+
+Usage:
+    python reconcile_counts.py [--dry-run]
+
+Options:
+    --dry-run          Report how far the rollups are out of step without changing them
+"""
+
+import psycopg2
+import os
+import sys
+import argparse
+from pathlib import Path
+from dotenv import load_dotenv
+
+# Load environment variables from .env file (existing environment variables win)
+load_dotenv(Path(__file__).parent / '.env', override=False)
+
+def get_postgres_connection():
+    """Get PostgreSQL connection from environment"""
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        raise ValueError("DATABASE_URL environment variable is not set. Please check your .env file.")
+    return psycopg2.connect(database_url)
+
+def rollup_drift(cursor):
+    """Compare page_views with the rollups.
+
+    Returns ``(visits, counted, stale_urls, visitors, tracked)``: total visits in
+    page_views and in url_counts, how many URLs have a wrong or missing count, and
+    distinct IPs in page_views against rows in visitor_ips.
+    """
+    cursor.execute("""
+        SELECT (SELECT COUNT(*) FROM page_views),
+               (SELECT COALESCE(SUM(count), 0)::bigint FROM url_counts),
+               (SELECT COUNT(*)
+                FROM (SELECT url, COUNT(*) AS count FROM page_views GROUP BY url) AS actual
+                FULL JOIN url_counts USING (url)
+                WHERE actual.count IS DISTINCT FROM url_counts.count),
+               (SELECT COUNT(DISTINCT ip_address) FROM page_views),
+               (SELECT COUNT(*) FROM visitor_ips)
+    """)
+    return cursor.fetchone()
+
+def report_drift(cursor):
+    """Print how page_views compares with the rollups; return (stale_urls, visitors, tracked)"""
+    visits, counted, stale_urls, visitors, tracked = rollup_drift(cursor)
+    print(f"   page_views: {visits:,} visits from {visitors:,} distinct IPs")
+    print(f"   rollups:    {counted:,} visits counted, {tracked:,} visitor IPs tracked")
+    print(f"   URLs with a wrong or missing count: {stale_urls:,}")
+    return stale_urls, visitors, tracked
+
+def reconcile_counts(dry_run=False):
+    """Rebuild url_counts and visitor_ips from page_views in one transaction"""
+    print("Reconciling visit rollups with page_views")
+    print("=" * 70)
+
+    pg_conn = get_postgres_connection()
+    cursor = pg_conn.cursor()
+
+    try:
+        # Checked without the lock first, so a run with nothing to fix never blocks the API
+        stale_urls, visitors, tracked = report_drift(cursor)
+        pg_conn.rollback()
+
+        if stale_urls == 0 and visitors == tracked:
+            print("   ✓ Rollups already match page_views")
+            return
+
+        if dry_run:
+            print(f"\n🔍 DRY RUN MODE - Would rebuild url_counts and visitor_ips")
+            return
+
+        # Blocks the visit writer's upserts (not plain reads) until we commit, so no
+        # batch can land between the recount and the rebuild
+        cursor.execute("LOCK TABLE url_counts, visitor_ips IN EXCLUSIVE MODE")
+        print("\n   Rechecking with the rollups locked...")
+        stale_urls, visitors, tracked = report_drift(cursor)
+        if stale_urls == 0 and visitors == tracked:
+            print("   ✓ Rollups caught up in the meantime")
+            pg_conn.rollback()
+            return
+
+        cursor.execute("DELETE FROM url_counts")
+        cursor.execute("INSERT INTO url_counts (url, count) SELECT url, COUNT(*) FROM page_views GROUP BY url")
+        print(f"   ✓ Rebuilt url_counts ({cursor.rowcount:,} URLs)")
+
+        cursor.execute("DELETE FROM visitor_ips")
+        cursor.execute("""
+            INSERT INTO visitor_ips (ip_address)
+            SELECT DISTINCT ip_address FROM page_views WHERE ip_address IS NOT NULL
+        """)
+        print(f"   ✓ Rebuilt visitor_ips ({cursor.rowcount:,} IPs)")
+
+        pg_conn.commit()
+
+    except Exception:
+        pg_conn.rollback()
+        raise
+
+    finally:
+        cursor.close()
+        pg_conn.close()
+
+    print("\n" + "=" * 70)
+    print("✓ Rollups rebuilt; /stats picks up the new totals within STATS_CACHE_TTL seconds")
+    print("=" * 70)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the url_counts and visitor_ips rollups from page_views",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Report how far the rollups are out of step without changing them"
+    )
+
+    args = parser.parse_args()
+
+    try:
+        reconcile_counts(dry_run=args.dry_run)
+    except KeyboardInterrupt:
+        print("\n\nReconcile cancelled by user.")
+        sys.exit(1)
+    except Exception as e:
+        print(f"\n✗ Error: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
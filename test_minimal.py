@@ -1,9 +1,22 @@
+import csv
+import io
+import json
 import requests
+import time
+import uuid
 from datetime import datetime, timedelta
 
 BASE_URL = "http://localhost:8000"
 
 
+def wait_for_writes(timeout=5):
+    """Visits are written in the background; wait until none are left unwritten"""
+    deadline = time.time() + timeout
+    while requests.get(f"{BASE_URL}/health").json()["queued_visits"]:
+        assert time.time() < deadline, "queued visits were not written in time"
+        time.sleep(0.05)
+
+
 def test_health():
     print("Testing /health endpoint...")
     r = requests.get(f"{BASE_URL}/health")
@@ -23,6 +36,31 @@ def test_post_visit():
     assert "timestamp" in data
 
 
+def test_visit_numbering():
+    print("Testing visit numbering across a background flush...")
+    url = f"https://example.com/numbering-{uuid.uuid4().hex}"
+    r = requests.post(f"{BASE_URL}/visit", json={"url": url})
+    assert r.json()["status"] == "Visit #1 recorded"
+    wait_for_writes()
+    # Now counted by url_counts rather than the queue; must not be counted twice or lost
+    r = requests.post(f"{BASE_URL}/visit", json={"url": url})
+    assert r.json()["status"] == "Visit #2 recorded"
+    wait_for_writes()
+    # /stats can serve its cached body for a couple of seconds after a write
+    deadline = time.time() + 5
+    while True:
+        pages = requests.get(f"{BASE_URL}/stats").json()["popular_pages"]
+        if url in pages or time.time() > deadline:
+            break
+        time.sleep(0.2)
+    if url in pages:
+        assert pages[url] == "2"
+    else:
+        # Only acceptable when 50 busier pages fill the list
+        assert len(pages) == 50
+        assert min(int(count.replace(",", "")) for count in pages.values()) >= 2
+
+
 def test_get_stats():
     print("Testing /stats endpoint...")
     r = requests.get(f"{BASE_URL}/stats")
@@ -34,6 +72,22 @@ def test_get_stats():
     assert "popular_pages" in data
 
 
+def test_stats_etag():
+    print("Testing /stats ETag / If-None-Match round trip...")
+    r = requests.get(f"{BASE_URL}/stats")
+    assert r.status_code == 200
+    etag = r.headers["ETag"]
+    assert r.headers["Cache-Control"].startswith("max-age=")
+    r = requests.get(f"{BASE_URL}/stats", headers={"If-None-Match": etag})
+    # A visit written in between would have moved the ETag on
+    if r.status_code == 200:
+        etag = r.headers["ETag"]
+        r = requests.get(f"{BASE_URL}/stats", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.headers["ETag"] == etag
+    assert not r.content
+
+
 def test_simple_get():
     print("Testing simple GET / endpoint...")
     url = "https://example.com/simple"
@@ -73,12 +127,68 @@ def test_all_visits_filters():
     print(f"Visits (limit=2): {len(data['visits'])}")
 
 
+def test_all_visits_limit_offset():
+    print("Testing /all-visits LIMIT/OFFSET binding...")
+    for i in range(3):
+        requests.post(f"{BASE_URL}/visit", json={"url": f"https://example.com/page-{i}"})
+    wait_for_writes()
+    r = requests.get(f"{BASE_URL}/all-visits?limit=10")
+    assert r.status_code == 200
+    assert len(r.json()["visits"]) <= 10
+    r = requests.get(f"{BASE_URL}/all-visits?limit=1&offset=1")
+    assert r.status_code == 200
+    assert len(r.json()["visits"]) == 1
+
+
+def test_all_visits_range():
+    print("Testing /all-visits range parsing...")
+    today = datetime.now().strftime("%Y-%m-%d")
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+    for value in (f"{today},{tomorrow}", f"{today}T00:00:00,{tomorrow}", f"{today} 00:00, {tomorrow} 00:00"):
+        r = requests.get(f"{BASE_URL}/all-visits", params={"range": value})
+        assert r.status_code == 200, value
+    for value in ("yesterday,today", f"2025-13-45,{today}"):
+        r = requests.get(f"{BASE_URL}/all-visits", params={"range": value})
+        assert r.status_code == 400, value
+
+
+def test_all_visits_jsonl():
+    print("Testing /all-visits?format=jsonl streaming...")
+    for i in range(3):
+        requests.post(f"{BASE_URL}/visit", json={"url": f"https://example.com/jsonl-{i}"})
+    wait_for_writes()
+    r = requests.get(f"{BASE_URL}/all-visits?format=jsonl&limit=3", stream=True)
+    assert r.status_code == 200
+    assert r.headers["Content-Type"].startswith("application/jsonl")
+    lines = [json.loads(line) for line in r.iter_lines() if line]
+    assert len(lines) == 3
+    assert set(lines[0]) == {"url", "ip", "user_agent", "timestamp"}
+
+
+def test_all_visits_csv():
+    print("Testing /all-visits?format=csv...")
+    requests.post(f"{BASE_URL}/visit", json={"url": "https://example.com/csv"})
+    wait_for_writes()
+    r = requests.get(f"{BASE_URL}/all-visits?format=csv&limit=2")
+    assert r.status_code == 200
+    assert r.headers["Content-Type"].startswith("text/csv")
+    rows = list(csv.reader(io.StringIO(r.text)))
+    assert rows[0] == ["url", "ip", "user_agent", "timestamp"]
+    assert len(rows) == 3
+
+
 def run_all():
     test_health()
     test_post_visit()
+    test_visit_numbering()
     test_get_stats()
+    test_stats_etag()
     test_simple_get()
     test_all_visits_filters()
+    test_all_visits_limit_offset()
+    test_all_visits_range()
+    test_all_visits_jsonl()
+    test_all_visits_csv()
     print("All tests passed!")
 
 if __name__ == "__main__":